@@ -5,6 +5,7 @@ from .storage import (
     get_valid_filename,
     setup,
     save_file,
+    save_files,
     file_exists,
     delete_file,
     file_url,
@@ -18,6 +19,7 @@ __all__ = [
     'get_valid_filename',
     'setup',
     'save_file',
+    'save_files',
     'file_exists',
     'delete_file',
     'file_url',
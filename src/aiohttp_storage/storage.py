@@ -1,55 +1,79 @@
 import asyncio
+import base64
 import os
 import re
+import shutil
+import stat
 import unicodedata
 from abc import ABCMeta, abstractmethod
-from functools import cached_property, partial, wraps
-from io import BufferedIOBase
+from collections import OrderedDict
+from functools import cached_property, lru_cache
+from io import BufferedIOBase, BufferedRandom, BufferedReader, FileIO
 from pathlib import Path
-from secrets import choice
-from string import ascii_letters, digits
-from typing import Awaitable, Callable, ParamSpec, TypeVar
+from typing import BinaryIO
 
 import aiofiles
 import aiofiles.os
 import aiofiles.ospath
 from aiohttp import web
 
-RANDOM_STRING_CHARS = ascii_letters + digits
+COPY_BUFSIZE = 1024 * 1024
+KNOWN_DIRS_MAXSIZE = 1024
 
-P = ParamSpec("P")
-T = TypeVar("T")
-
-FILE_STORAGE_APP_KEY = "file_storage"
+_INVALID_FILENAME_RE = re.compile(r"[^\w.-]")
+# Same filter as _INVALID_FILENAME_RE, restricted to ASCII
+_ASCII_INVALID_FILENAME_TABLE = str.maketrans(
+    "", "", "".join(_INVALID_FILENAME_RE.findall("".join(map(chr, range(128)))))
+)
+_SUSPICIOUS_NAMES: frozenset[str] = frozenset(("", ".", ".."))
 
 
 class SuspiciousFileOperation(ValueError):
     ...
 
 
+@lru_cache(maxsize=1024)
 def get_valid_filename(name: str) -> str:
-    s = str(name).strip().replace(" ", "_")
-    s = unicodedata.normalize("NFKD", s)
-    s = re.sub(r"[^\w.-]", "", s)
-    if s in {"", ".", ".."}:
+    s = name.strip().replace(" ", "_")
+    if s.isascii():
+        # ASCII strings are always NFKD-normalized, strip with a lookup table
+        s = s.translate(_ASCII_INVALID_FILENAME_TABLE)
+    else:
+        if not unicodedata.is_normalized("NFKD", s):
+            s = unicodedata.normalize("NFKD", s)
+        s = _INVALID_FILENAME_RE.sub("", s)
+    if s in _SUSPICIOUS_NAMES:
         raise SuspiciousFileOperation(f"Could not derive file name from '{name}'")
     return s
 
 
-def safe_join(base: str | Path, *path: str | Path) -> str:
-    base_path = Path(base).resolve()
-    joined_path = base_path.joinpath(*path).resolve()
-    if not joined_path.is_relative_to(base_path):
-        raise SuspiciousFileOperation(
-            f"Path {joined_path} is not subpath of {base_path}"
-        )
-    return str(joined_path)
+def safe_join(
+    base: str | Path, *path: str | Path, base_already_resolved: bool = False
+) -> str:
+    # Callers holding an already resolved base skip the realpath syscalls
+    base_str = str(base) if base_already_resolved else str(Path(base).resolve())
+    # Normalize lexically, like os.path.abspath, instead of resolving
+    # symlinks with lstat calls on every path component
+    joined_str = os.path.normpath(os.path.join(base_str, *path))
+    base_prefix = base_str if base_str.endswith(os.sep) else base_str + os.sep
+    if not (joined_str == base_str or joined_str.startswith(base_prefix)):
+        raise SuspiciousFileOperation(f"Path {joined_str} is not subpath of {base_str}")
+    return joined_str
 
 
 def validate_file_name(filename: str | Path, allow_relative_path=False):
+    # Plain names without path separators need no Path parsing
+    if (
+        isinstance(filename, str)
+        and filename not in _SUSPICIOUS_NAMES
+        and "/" not in filename
+        and os.sep not in filename
+    ):
+        return filename
+
     # Remove potentially dangerous names
     path = Path(filename)
-    if path.name in {"", ".", ".."}:
+    if path.name in _SUSPICIOUS_NAMES:
         raise SuspiciousFileOperation(f"Could not derive file name from '{filename}'")
 
     if allow_relative_path:
@@ -63,13 +87,47 @@ def validate_file_name(filename: str | Path, allow_relative_path=False):
     return filename
 
 
-def run_async(func: Callable[P, T]) -> Callable[P, Awaitable[T]]:
-    @wraps(func)
-    async def wrapper(*args: P.args, **kwargs: P.kwargs) -> T:
-        loop = asyncio.get_running_loop()
-        return await loop.run_in_executor(None, partial(func, *args, **kwargs))
+def _is_plain_file(src: BufferedIOBase) -> bool:
+    # Wrappers such as GzipFile expose the fd of the underlying file while
+    # tell() and read() work on the transformed stream
+    if isinstance(src, FileIO):
+        return True
+    return isinstance(src, (BufferedReader, BufferedRandom)) and isinstance(
+        src.raw, FileIO
+    )
+
+
+def _sendfile(src: BufferedIOBase, dst: BinaryIO) -> bool:
+    # Zero-copy transfer for regular files, returns False if not applicable
+    if not hasattr(os, "sendfile") or not _is_plain_file(src):
+        return False
+    try:
+        in_fd = src.fileno()
+        offset = start = src.tell()
+        st = os.fstat(in_fd)
+    except (AttributeError, OSError):
+        return False
+    if not stat.S_ISREG(st.st_mode):
+        return False
+    out_fd = dst.fileno()
+    while offset < st.st_size:
+        try:
+            sent = os.sendfile(out_fd, in_fd, offset, st.st_size - offset)
+        except OSError:
+            if offset == start:
+                return False
+            raise
+        if sent == 0:
+            break
+        offset += sent
+    src.seek(offset)
+    return True
+
 
-    return wrapper
+def _sync_exclusive_copy(path: str, src: BufferedIOBase) -> None:
+    with open(path, "xb") as dst:
+        if not _sendfile(src, dst):
+            shutil.copyfileobj(src, dst, COPY_BUFSIZE)
 
 
 class AbstractStorage(metaclass=ABCMeta):
@@ -97,6 +155,24 @@ class AbstractStorage(metaclass=ABCMeta):
     async def delete(self, filename: str):
         ...
 
+    async def save_files(
+        self, items: list[tuple[str, BufferedIOBase]], max_len: int = 0
+    ) -> list[str]:
+        # Saved names are returned in the same order as items. If any save
+        # fails, the files saved by the others are deleted and the error raised
+        results = await asyncio.gather(
+            *(self.save(filename, data, max_len) for filename, data in items),
+            return_exceptions=True,
+        )
+        errors = [r for r in results if isinstance(r, BaseException)]
+        if errors:
+            await asyncio.gather(
+                *(self.delete(r) for r in results if isinstance(r, str)),
+                return_exceptions=True,
+            )
+            raise errors[0]
+        return results
+
 
 class BaseStorage(AbstractStorage):
     async def save(self, filename: str, data: BufferedIOBase, max_len: int = 0) -> str:
@@ -105,34 +181,74 @@ class BaseStorage(AbstractStorage):
         validate_file_name(filename, allow_relative_path=True)
         return filename
 
-    async def get_available_filename(self, filename: str, max_len: int = 0) -> str:
+    async def save_files(
+        self, items: list[tuple[str, BufferedIOBase]], max_len: int = 0
+    ) -> list[str]:
+        # Reject the whole batch before anything is written
+        filenames = [filename for filename, _ in items]
+        for filename in filenames:
+            self._validate_filename(filename)
+        await self._prepare_save_files(filenames)
+        return await super().save_files(items, max_len)
+
+    async def _prepare_save_files(self, filenames: list[str]):
+        pass
+
+    def _validate_filename(self, filename: str) -> Path:
         origin_path = Path(filename)
         if ".." in origin_path.parts:
             raise SuspiciousFileOperation(
                 f"Detected path traversal '{origin_path.parent}'"
             )
         validate_file_name(origin_path.name)
-        while await self.exists(filename) or (max_len > 0 and len(filename) > max_len):
-            filename = str(
-                origin_path.with_stem(self.get_alternative_stem(origin_path.stem))
-            )
-            if max_len <= 0:
-                continue
-            truncation = len(filename) - max_len
-            if truncation > 0:
-                print(origin_path)
-                truncated_stem = origin_path.stem[:-truncation]
-                if not truncated_stem:
-                    raise SuspiciousFileOperation(
-                        f"Storage can not find an available filename for '{origin_path}'."
-                    )
-                filename = str(
-                    origin_path.with_stem(self.get_alternative_stem(truncated_stem))
+        return origin_path
+
+    async def get_available_filename(self, filename: str, max_len: int = 0) -> str:
+        # Parse the filename once, the retry loop only works with these strings
+        origin_path = self._validate_filename(filename)
+        stem, suffix = origin_path.stem, origin_path.suffix
+        parent = str(origin_path.parent)
+        if not await self.exists(filename) and not (0 < max_len < len(filename)):
+            return filename
+        prefix = "" if parent == "." else os.path.join(parent, "")
+        # A random candidate rarely collides, so start with a single one and
+        # only grow the batch on repeated collisions
+        batch_size = 1
+        while True:
+            candidates = [
+                self._get_alternative_filename(prefix, stem, suffix, max_len)
+                for _ in range(batch_size)
+            ]
+            results = await self._exists_many(candidates)
+            for candidate, exists in zip(candidates, results):
+                if not exists:
+                    return candidate
+            batch_size = min(batch_size * 2, 16)
+
+    async def _exists_many(self, filenames: list[str]) -> list[bool]:
+        return await asyncio.gather(*(self.exists(f) for f in filenames))
+
+    def _get_alternative_filename(
+        self, prefix: str, stem: str, suffix: str, max_len: int = 0
+    ) -> str:
+        filename = f"{prefix}{self.get_alternative_stem(stem)}{suffix}"
+        if max_len <= 0:
+            return filename
+        truncation = len(filename) - max_len
+        if truncation > 0:
+            truncated_stem = stem[:-truncation]
+            if not truncated_stem:
+                raise SuspiciousFileOperation(
+                    f"Storage can not find an available filename for "
+                    f"'{prefix}{stem}{suffix}'."
                 )
+            filename = f"{prefix}{self.get_alternative_stem(truncated_stem)}{suffix}"
         return filename
 
     def get_alternative_stem(self, stem: str, random_length=7, sep="_") -> str:
-        s = "".join([choice(RANDOM_STRING_CHARS) for i in range(random_length)])
+        # Random suffix is made of [A-Z2-7], 5 bits per char
+        nbytes = (random_length * 5 + 7) // 8
+        s = base64.b32encode(os.urandom(nbytes)).decode("ascii")[:random_length]
         return f"{stem}{sep}{s}"
 
     async def _save(self, filename: str, data: BufferedIOBase) -> str:
@@ -152,6 +268,8 @@ class FileSystemStorage(BaseStorage):
     def __init__(self, location: str | Path, base_url: str | None = None):
         self._location = location
         self._base_url = base_url
+        # Recently created directories (LRU), to skip makedirs calls
+        self._known_dirs: OrderedDict[str, None] = OrderedDict()
 
     @cached_property
     def location(self) -> Path:
@@ -163,38 +281,72 @@ class FileSystemStorage(BaseStorage):
             raise ValueError("Invalid base_url")
         return self._base_url.rstrip("/")
 
+    def _path(self, filename: str) -> str:
+        # location is resolved once by its cached_property
+        return safe_join(self.location, filename, base_already_resolved=True)
+
     async def exists(self, filename: str) -> bool:
-        dst_path = safe_join(self.location, filename)
-        return await run_async(os.path.lexists)(dst_path)
+        dst_path = self._path(filename)
+        return await asyncio.to_thread(os.path.lexists, dst_path)
+
+    async def _exists_many(self, filenames: list[str]) -> list[bool]:
+        # Check the whole batch in a single executor round-trip
+        dst_paths = [self._path(filename) for filename in filenames]
+        return await asyncio.to_thread(
+            lambda: [os.path.lexists(dst_path) for dst_path in dst_paths]
+        )
 
     async def _save(self, filename: str, data: BufferedIOBase) -> str:
-        print(filename)
-        dst_path = Path(safe_join(self.location, filename))
-        try:
-            await aiofiles.os.makedirs(dst_path.parent, exist_ok=True)
-        except FileExistsError:
-            raise FileExistsError(f"{dst_path.parent} exists and its not a directory")
+        dst_path = self._path(filename)
+        dst_parent = os.path.dirname(dst_path)
+        await self._makedirs(dst_parent)
         while True:
             try:
-                async with aiofiles.open(dst_path, "xb") as fd:
-                    await fd.write(data.read())
+                # open, copy and close in a single executor round-trip
+                await asyncio.to_thread(_sync_exclusive_copy, dst_path, data)
 
+            except FileNotFoundError:
+                # Directory was removed behind our back, recreate it
+                self._known_dirs.pop(dst_parent, None)
+                await self._makedirs(dst_parent)
             except FileExistsError:
-                print("exists")
                 filename = await self.get_available_filename(filename)
-                dst_path = Path(safe_join(self.location, filename))
+                dst_path = self._path(filename)
+                dst_parent = os.path.dirname(dst_path)
             else:
                 break
 
         return filename
 
+    async def _prepare_save_files(self, filenames: list[str]):
+        # Create each distinct parent directory once before the concurrent saves
+        parents = {os.path.dirname(self._path(filename)) for filename in filenames}
+        await asyncio.gather(*(self._makedirs(parent) for parent in parents))
+
+    async def _makedirs(self, path: str):
+        if path in self._known_dirs:
+            self._known_dirs.move_to_end(path)
+            return
+        try:
+            await aiofiles.os.makedirs(path, exist_ok=True)
+        except FileExistsError:
+            raise FileExistsError(f"{path} exists and its not a directory")
+        self._known_dirs[path] = None
+        if len(self._known_dirs) > KNOWN_DIRS_MAXSIZE:
+            self._known_dirs.popitem(last=False)
+
     async def url(self, filename: str) -> str:
         validate_file_name(filename, allow_relative_path=True)
         return f"{self.base_url}/{filename.lstrip('/')}"
 
     async def delete(self, filename: str):
         if await self.exists(filename):
-            await aiofiles.os.unlink(safe_join(self.location, filename))
+            await aiofiles.os.unlink(self._path(filename))
+
+
+FILE_STORAGE_APP_KEY: web.AppKey[AbstractStorage] = web.AppKey(
+    "file_storage", AbstractStorage
+)
 
 
 def setup(app: web.Application, storage: AbstractStorage):
@@ -214,6 +366,12 @@ async def save_file(
     return await get_storage(request).save(filename, data, max_len)
 
 
+async def save_files(
+    request: web.Request, items: list[tuple[str, BufferedIOBase]], max_len=0
+) -> list[str]:
+    return await get_storage(request).save_files(items, max_len)
+
+
 async def delete_file(request: web.Request, filename: str):
     await get_storage(request).delete(filename)
 
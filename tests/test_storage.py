@@ -1,18 +1,25 @@
+import gzip
 import os
 import shutil
 import sys
 import unittest
 from io import BytesIO
-from unittest.mock import AsyncMock
+from unittest.mock import AsyncMock, patch
+
+from aiohttp import web
 
 
 sys.path.append("./src")
 from aiohttp_storage.storage import (
+    FILE_STORAGE_APP_KEY,
+    AbstractStorage,
     BaseStorage,
     FileSystemStorage,
     SuspiciousFileOperation,
     get_valid_filename,
     safe_join,
+    setup,
+    validate_file_name,
 )
 
 
@@ -32,8 +39,95 @@ class TestBaseStorage(unittest.IsolatedAsyncioTestCase):
         self.assertNotEqual(self.filename, filename)
         self.assertEqual(len(self.filename) + 8, len(filename))
 
+    async def test_available_name_batch_collision(self):
+        # The original name and the batches of 1, 2 and 4 candidates are taken
+        self.storage.exists = AsyncMock(side_effect=[True] * 8 + [False] * 8)
+        filename = await self.storage.get_available_filename(self.filename)
+        self.assertNotEqual(self.filename, filename)
+        self.assertEqual(self.storage.exists.await_count, 16)
+
+    async def test_available_name_single_check(self):
+        await self.storage.get_available_filename(self.filename)
+        self.assertEqual(self.storage.exists.await_count, 2)
+
+    async def test_available_name_max_len(self):
+        filename = await self.storage.get_available_filename(self.filename, max_len=16)
+        self.assertEqual(len(filename), 16)
+        self.assertTrue(filename.endswith(".txt"))
+
+    async def test_available_name_keeps_parent(self):
+        self.storage.exists = AsyncMock(side_effect=lambda n: n == "some/dir/file.txt")
+        filename = await self.storage.get_available_filename("some/dir/file.txt")
+        self.assertRegex(filename, r"^some/dir/file_\w{7}\.txt$")
+
     def test_valid_filename(self):
         self.assertEqual("test_some_file.jpg", get_valid_filename("test some file.jpg"))
+        self.assertEqual("cafe.jpg", get_valid_filename("caf\u00e9.jpg"))
+        self.assertEqual("a_b-c.d", get_valid_filename(" a b-c.d/?*\x00\t"))
+        with self.assertRaises(SuspiciousFileOperation):
+            get_valid_filename("..")
+
+
+class ValidateFileNameTests(unittest.TestCase):
+    def test_plain_name(self):
+        self.assertEqual("file.txt", validate_file_name("file.txt"))
+        self.assertEqual(".hidden", validate_file_name(".hidden"))
+        for name in ("", ".", ".."):
+            with self.assertRaises(SuspiciousFileOperation):
+                validate_file_name(name)
+
+    def test_path_elements(self):
+        with self.assertRaises(SuspiciousFileOperation):
+            validate_file_name("some/file.txt")
+        self.assertEqual(
+            "some/file.txt",
+            validate_file_name("some/file.txt", allow_relative_path=True),
+        )
+        for name in ("/abs/file.txt", "some/../file.txt", "some/.."):
+            with self.assertRaises(SuspiciousFileOperation):
+                validate_file_name(name, allow_relative_path=True)
+
+
+class MemoryStorage(AbstractStorage):
+    def __init__(self):
+        self.files = {}
+
+    async def save(self, filename, data, max_len=0):
+        if filename in self.files:
+            raise FileExistsError(filename)
+        self.files[filename] = data.read()
+        return filename
+
+    async def exists(self, filename):
+        return filename in self.files
+
+    async def get_available_filename(self, filename, max_len=0):
+        return filename
+
+    def get_alternative_stem(self, stem):
+        return stem
+
+    async def url(self, filename):
+        return filename
+
+    async def delete(self, filename):
+        self.files.pop(filename, None)
+
+
+class TestAbstractStorage(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.storage = MemoryStorage()
+
+    async def test_save_files(self):
+        items = [("a.txt", BytesIO(b"a")), ("b.txt", BytesIO(b"b"))]
+        self.assertEqual(await self.storage.save_files(items), ["a.txt", "b.txt"])
+        self.assertEqual(self.storage.files, {"a.txt": b"a", "b.txt": b"b"})
+
+    async def test_save_files_cleans_up_on_failure(self):
+        items = [("a.txt", BytesIO(b"a")), ("a.txt", BytesIO(b"b"))]
+        with self.assertRaises(FileExistsError):
+            await self.storage.save_files(items)
+        self.assertEqual(self.storage.files, {})
 
 
 class TestFileSystemStorage(unittest.IsolatedAsyncioTestCase):
@@ -61,6 +155,81 @@ class TestFileSystemStorage(unittest.IsolatedAsyncioTestCase):
         self.assertFalse(await self.storage.exists(filename_0))
         self.assertFalse(await self.storage.exists(filename_1))
 
+    async def test_save_files_rejects_invalid_name(self):
+        items = [
+            ("a/a.txt", BytesIO(b"a")),
+            ("x/..", BytesIO(b"x")),
+            ("c.txt", BytesIO(b"c")),
+        ]
+        with self.assertRaises(SuspiciousFileOperation):
+            await self.storage.save_files(items)
+        self.assertEqual(list(self.storage.location.iterdir()), [])
+
+    async def test_save_files_cleans_up_on_failure(self):
+        items = [
+            ("a.txt", BytesIO(b"a")),
+            ("b.txt", BytesIO(b"b")),
+        ]
+        await self.storage.save("b.txt", BytesIO(b"existing"))
+        # No alternative name for "b.txt" fits in max_len
+        with self.assertRaises(SuspiciousFileOperation):
+            await self.storage.save_files(items, max_len=5)
+        self.assertEqual([p.name for p in self.storage.location.iterdir()], ["b.txt"])
+
+    async def test_exists_many(self):
+        await self.storage.save("taken.txt", BytesIO(b"1"))
+        self.assertEqual(
+            await self.storage._exists_many(["taken.txt", "free.txt"]), [True, False]
+        )
+
+    async def test_save_files(self):
+        items = [
+            ("dir/a.txt", BytesIO(b"a")),
+            ("dir/b.txt", BytesIO(b"b")),
+            ("dir/a.txt", BytesIO(b"c")),
+        ]
+        filenames = await self.storage.save_files(items)
+        self.assertEqual(filenames[1], "dir/b.txt")
+        self.assertEqual(len(set(filenames)), 3)
+        contents = [(self.storage.location / f).read_bytes() for f in filenames]
+        self.assertEqual(contents, [b"a", b"b", b"c"])
+
+    async def test_save_real_file(self):
+        src_path = self.storage.location / "source.bin"
+        src_path.write_bytes(b"header" + os.urandom(4096))
+        with open(src_path, "rb") as src:
+            src.read(6)
+            filename = await self.storage.save("copy.bin", src)
+            self.assertEqual(src.read(), b"")
+        self.assertEqual(
+            (self.storage.location / filename).read_bytes(),
+            src_path.read_bytes()[6:],
+        )
+
+    async def test_save_gzip_file(self):
+        content = b"Some decompressed bytes\n" * 50
+        src_path = self.storage.location / "source.gz"
+        src_path.write_bytes(gzip.compress(content))
+        with gzip.open(src_path, "rb") as src:
+            filename = await self.storage.save("copy.txt", src)
+        self.assertEqual((self.storage.location / filename).read_bytes(), content)
+
+    async def test_save_file_recreates_removed_dir(self):
+        filename = "sub/sample_filename.txt"
+        self.assertEqual(filename, await self.storage.save(filename, BytesIO(b"1")))
+        shutil.rmtree(self.storage.location / "sub")
+        self.assertEqual(filename, await self.storage.save(filename, BytesIO(b"2")))
+        self.assertTrue(await self.storage.exists(filename))
+
+    async def test_known_dirs_bounded(self):
+        with patch("aiohttp_storage.storage.KNOWN_DIRS_MAXSIZE", 2):
+            for name in ("a/f.txt", "b/f.txt", "a/g.txt", "c/f.txt"):
+                await self.storage.save(name, BytesIO(b"1"))
+        self.assertEqual(
+            list(self.storage._known_dirs),
+            [str(self.storage.location / "a"), str(self.storage.location / "c")],
+        )
+
     async def test_file_url(self):
         filename = "some_file.txt"
         with self.assertRaises(ValueError):
@@ -98,3 +267,29 @@ class SafeJoinTests(unittest.TestCase):
     def test_parent_path(self):
         with self.assertRaises(SuspiciousFileOperation):
             safe_join("/abc/", "../def")
+
+    def test_normalized_path(self):
+        drive, path = os.path.splitdrive(safe_join("/abc/", "def/../ghi"))
+        self.assertEqual(path, "{0}abc{0}ghi".format(os.path.sep))
+        with self.assertRaises(SuspiciousFileOperation):
+            safe_join("/abc/", "def/../../ghi")
+
+    def test_base_already_resolved(self):
+        drive, path = os.path.splitdrive(
+            safe_join("/abc", "def", base_already_resolved=True)
+        )
+        self.assertEqual(path, "{0}abc{0}def".format(os.path.sep))
+        with self.assertRaises(SuspiciousFileOperation):
+            safe_join("/abc", "../def", base_already_resolved=True)
+
+    def test_sibling_with_common_prefix(self):
+        with self.assertRaises(SuspiciousFileOperation):
+            safe_join("/abc/", "../abcdef")
+
+
+class SetupTests(unittest.TestCase):
+    def test_setup(self):
+        app = web.Application()
+        storage = FileSystemStorage("test_storage")
+        setup(app, storage)
+        self.assertIs(app[FILE_STORAGE_APP_KEY], storage)